@@ -3,18 +3,23 @@
 #-------------------------------------------------------------------------------
 
 import argparse
+import gzip
+import hashlib
 import json
+import ntpath
 import os
 import re
 import subprocess
 import sys
 import textwrap
+import worker_pool
 
 
 MY_NAME = os.path.basename(__file__)
 MAGIC_PATH = 'C:\\Program Files\\Microsoft Visual Studio\\2022\\Community\\VC\\Tools\\MSVC\\14.33.31629\\bin\\Hostx64\\x64'
 DEFAULT_EXP_OUTPUT='exports.json'
 DEFAULT_IMP_OUTPUT='imports.json'
+ARCHIVE_INDEX='index.json'
 
 DESCRIPTION = f"""
 Index the executable files in the --target_dir, taking the information from
@@ -22,11 +27,22 @@ Index the executable files in the --target_dir, taking the information from
     {DEFAULT_EXP_OUTPUT} and {DEFAULT_IMP_OUTPUT}
   --studio_dir may for example be
         {MAGIC_PATH}
+  Files where dumpbin hits --timeout are skipped and listed in
+    {worker_pool.DEFAULT_QUARANTINE_OUTPUT}
+    (--memory_limit is refused on Windows, where it cannot be enforced)
+  --record saves the raw dumpbin output of every file in an archive, keyed on
+    the content of the file, and --replay parses that archive again without
+    running dumpbin at all (and then --target_dir is not needed). Replay
+    parses in this process, so -j, --timeout, --memory_limit and
+    --max_tasks do nothing there
 """
 USAGE_EXAMPLE = f"""
 Example:
 > {MY_NAME} -t ../data
 > {MY_NAME} -t ../data -u just_this.dll
+> {MY_NAME} -t ../data --timeout 30 -j 8
+> {MY_NAME} -t ../data --record ../dumpbin_archive
+> {MY_NAME} --replay ../dumpbin_archive
 """
 
 #-------------------------------------------------------------------------------
@@ -45,7 +61,6 @@ def parse_arguments():
         default=MAGIC_PATH,
         help='Where your dumpbin.exe is located')
     add('-t', '--target_dir', metavar='bin-dir',
-        required=True,
         help='root path to check (recursively)')
     add('-u', '--unly_one', metavar='dll_under_test.dll',
         help='exports from this exe only')
@@ -54,8 +69,20 @@ def parse_arguments():
         help='be more quiet')
     add('-v', '--verbose', action='store_true',
         help='be more verbose')
+    worker_pool.add_pool_arguments(add)
 
-    return parser.parse_args()
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--record', metavar='ARCHIVE_DIR',
+        help='save the raw dumpbin output in ARCHIVE_DIR')
+    archive.add_argument('--replay', metavar='ARCHIVE_DIR',
+        help='parse the dumpbin output saved in ARCHIVE_DIR, in this ' +
+            'process (ignores -j, --timeout, --memory_limit, --max_tasks)')
+
+    options = parser.parse_args()
+    worker_pool.check_pool_arguments(parser, options)
+    if not options.target_dir and not options.replay:
+        parser.error('the following arguments are required: -t/--target_dir')
+    return options
 
 #-------------------------------------------------------------------------------
 '''Get current code page'''
@@ -72,7 +99,7 @@ def ccp():
         return ccp.codepage
 
 #-------------------------------------------------------------------------------
-def run_process(command, do_check, extra_dir=os.getcwd()):
+def run_process(command, do_check, extra_dir=os.getcwd(), timeout=None):
     try:
         my_command = command
         status = subprocess.run(command,
@@ -80,13 +107,17 @@ def run_process(command, do_check, extra_dir=os.getcwd()):
                                 stderr=subprocess.PIPE,
                                 text=True,
                                 encoding=ccp(),  # See https://bugs.python.org/issue27179
-                                check=do_check)
+                                check=do_check,
+                                timeout=timeout)
         if status.returncode == 0:
             reply = status.stdout
         else:
             reply = status.stdout
             reply += status.stderr
 
+    except subprocess.TimeoutExpired:
+        # Let the caller decide what to do with a hung process
+        raise
     except Exception as e:
         reply = '\n-start of exception-\n'
         reply += f'The command\n>{command}\nthrew an exception'
@@ -101,6 +132,82 @@ def run_process(command, do_check, extra_dir=os.getcwd()):
 
     return reply
 
+#-------------------------------------------------------------------------------
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+#-------------------------------------------------------------------------------
+def archive_object(archive, digest, switch):
+    return os.path.join(archive, 'objects', digest[:2],
+        f'{digest}.{switch}.txt.gz')
+
+#-------------------------------------------------------------------------------
+def read_archive_object(file):
+    with gzip.open(file, 'rt', encoding='utf-8') as fp:
+        return fp.read()
+
+#-------------------------------------------------------------------------------
+def write_archive_object(file, output):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    # Write aside and rename, so a killed worker never leaves half an object
+    temp_file = f'{file}.{os.getpid()}.tmp'
+    with gzip.open(temp_file, 'wt', encoding='utf-8') as fp:
+        fp.write(output)
+    try:
+        os.replace(temp_file, file)
+    except OSError:
+        # Another worker recorded an identical binary first (and Windows will
+        # not replace a file that is open). Same digest, same content.
+        os.remove(temp_file)
+        if not os.path.exists(file):
+            raise
+
+#-------------------------------------------------------------------------------
+def dumpbin_output(path_of_exe, switch, options):
+    archive = options.replay or options.record
+    if archive:
+        digest = options.archive_index[path_of_exe]
+        recorded = archive_object(archive, digest, switch)
+        # Identical binaries share their recorded output
+        if options.replay or os.path.exists(recorded):
+            return read_archive_object(recorded)
+
+    commando = f'"{options.dumpbin}" /{switch} {path_of_exe}'
+    if options.verbose:
+        print('  ' + commando)
+    output = run_process(commando, True, timeout=options.timeout)
+    if options.record and not output.startswith('\n-start of exception-'):
+        write_archive_object(recorded, output)
+    return output
+
+#-------------------------------------------------------------------------------
+def run_per_file(func, files, args, options, quarantine, phase):
+    if not options.replay:
+        # dumpbin gets the same timeout, let it hit that one first
+        return worker_pool.run_guarded(func, files, args, options,
+            quarantine, phase, worker_pool.GRACE_TIME)
+
+    # Only parsing left to do, so no need for any worker processes
+    results = {}
+    for file in files:
+        try:
+            results[file] = func(file, *args)
+            continue
+        except (KeyError, OSError) as e:
+            reason, message = 'missing', f'{type(e).__name__}: {e}'
+        except Exception as e:
+            # Like worker_main(), so a parser bug only costs this file
+            reason, message = 'error', f'{type(e).__name__}: {e}'
+        if not options.quiet:
+            print(f'  Quarantined {file} ({reason})')
+        quarantine.append({'file': file, 'phase': phase,
+            'reason': reason, 'message': message})
+    return results
+
 #-------------------------------------------------------------------------------
 def list_all_files(directory, the_chosen_files, ext):
 
@@ -154,26 +261,25 @@ def parse_out_the_exports(the_exe, the_input, options):
 
 #-------------------------------------------------------------------------------
 def get_export(path_of_exe, options):
-    commando = f'{options.dumpbin} /exports {path_of_exe}'
     if options.verbose:
-        print('  ' + commando)
-    output = run_process(commando, True)
+        print(path_of_exe)
+    output = dumpbin_output(path_of_exe, 'exports', options)
     exported_functions = parse_out_the_exports(path_of_exe, output.splitlines(),
         options)
     return exported_functions
 
 #-------------------------------------------------------------------------------
-def get_exports(executables, options):
-    exports = {}
+def get_exports(executables, options, quarantine):
+    exes = []
     for exe in executables:
-        if options.unly_one and os.path.basename(exe) != options.unly_one:
+        if options.unly_one and ntpath.basename(exe) != options.unly_one:
             if options.verbose:
                 print(f'Skipping {exe} because of -u {options.unly_one}')
             continue
-        if options.verbose:
-            print(exe)
-        exports[exe] = get_export(exe, options)
+        exes.append(exe)
 
+    exports = run_per_file(get_export, exes, (options,),
+        options, quarantine, 'exports')
     return exports
 
 #-------------------------------------------------------------------------------
@@ -257,33 +363,31 @@ def parse_out_the_imports(the_exe, interesting_exes, the_input, options):
 
 #-------------------------------------------------------------------------------
 def get_import(path_of_exe, imports, interesting_exes, options):
-    commando = f'"{options.dumpbin}" /imports {path_of_exe}'
     if options.verbose:
-        print('  ' + commando)
-    output = run_process(commando, True)
+        print(path_of_exe)
+    output = dumpbin_output(path_of_exe, 'imports', options)
     imported_from_dlls = parse_out_the_imports(path_of_exe, interesting_exes,
         output.splitlines(), options)
     return imported_from_dlls
 
 #-------------------------------------------------------------------------------
-def get_imports(executables, options):
+def get_imports(executables, options, quarantine):
     imports = {}
     interesting_dll_names = get_basenames(executables)
-    print('Collecting the imports')
-    for exe in executables:
-        if options.verbose:
-            print(exe)
-        imports_from_dlls = get_import(exe, imports, interesting_dll_names,
-            options)
-        imports[os.path.basename(exe)] = imports_from_dlls
+    imports_from_exes = run_per_file(get_import, executables,
+        (imports, interesting_dll_names, options), options, quarantine,
+        'imports')
+    for exe, imports_from_dlls in imports_from_exes.items():
+        imports[ntpath.basename(exe)] = imports_from_dlls
 
     return imports
 
 #-------------------------------------------------------------------------------
 def get_basenames(inputs):
     outputs = []
+    # Windows paths, also when replaying a recorded archive on another OS
     for input in inputs:
-        outputs.append(os.path.basename(input))
+        outputs.append(ntpath.basename(input))
 
     return outputs
 
@@ -292,23 +396,50 @@ def store_json_data(file, data):
     with open(file, 'w') as fp:
         json.dump(data, fp, indent=2)
 
+#-------------------------------------------------------------------------------
+def load_json_data(file):
+    with open(file) as fp:
+        return json.load(fp)
+
 #-------------------------------------------------------------------------------
 def main():
     options = parse_arguments()
     root = options.target_dir
-    dumpbin = os.path.join(options.studio_dir, 'dumpbin.exe')
-    if not os.path.exists(dumpbin):
-        print(f'No dumpbin found as {dumpbin}')
-        return 3
-    options.dumpbin = dumpbin
 
-    exes = list_all_executables(root)
-    if len(exes) == 0:
-        print(f'No executables found in directory {root}')
-        return 3
+    if options.replay:
+        index_file = os.path.join(options.replay, ARCHIVE_INDEX)
+        if not os.path.exists(index_file):
+            print(f'No recorded archive found as {index_file}')
+            return 3
+        options.archive_index = load_json_data(index_file)
+        exes = list(options.archive_index.keys())
+        if len(exes) == 0:
+            print(f'No executables recorded in {options.replay}')
+            return 3
+    else:
+        dumpbin = os.path.join(options.studio_dir, 'dumpbin.exe')
+        if not os.path.exists(dumpbin):
+            print(f'No dumpbin found as {dumpbin}')
+            return 3
+        options.dumpbin = dumpbin
+
+        exes = list_all_executables(root)
+        if len(exes) == 0:
+            print(f'No executables found in directory {root}')
+            return 3
+
+    quarantine = []
+    if options.record:
+        print(f'Hashing the executables for {options.record}')
+        options.archive_index = worker_pool.run_guarded(file_digest, exes,
+            (), options, quarantine, 'hash')
+        exes = list(options.archive_index.keys())
+        if len(exes) == 0:
+            print(f'No executables could be read in directory {root}')
+            return 3
 
     print('Collecting the exports')
-    exports = get_exports(exes, options)
+    exports = get_exports(exes, options, quarantine)
 
     if not len(exports):
         print(f'Got no exports - giving up')
@@ -318,9 +449,25 @@ def main():
 
     # Then go another round to insert the imports
     print('Collecting the imports')
-    imports = get_imports(exes, options)
+    imports = get_imports(exes, options, quarantine)
     store_json_data(DEFAULT_IMP_OUTPUT, imports)
     print(f'  Saved as {DEFAULT_IMP_OUTPUT}')
+
+    if options.record:
+        # Only index the files that got all their output recorded
+        quarantined_files = {entry['file'] for entry in quarantine}
+        recorded_index = {exe: digest
+            for exe, digest in options.archive_index.items()
+            if exe not in quarantined_files}
+        index_file = os.path.join(options.record, ARCHIVE_INDEX)
+        os.makedirs(options.record, exist_ok=True)
+        store_json_data(index_file, recorded_index)
+        print(f'  Saved as {index_file}')
+
+    if quarantine:
+        store_json_data(worker_pool.DEFAULT_QUARANTINE_OUTPUT, quarantine)
+        print(f'  {len(quarantine)} files quarantined, see ' +
+            f'{worker_pool.DEFAULT_QUARANTINE_OUTPUT}')
     return 0
 
 #-------------------------------------------------------------------------------
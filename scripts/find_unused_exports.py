@@ -3,11 +3,16 @@
 #-------------------------------------------------------------------------------
 
 import argparse
+import heapq
+import itertools
 import json
+import ntpath
 import os
+import pickle
 import re
 import subprocess
 import sys
+import tempfile
 import textwrap
 
 
@@ -15,11 +20,23 @@ MY_NAME = os.path.basename(__file__)
 DEFAULT_EXP_OUTPUT='exports.json'
 DEFAULT_IMP_OUTPUT='imports.json'
 DEFAULT_UNREF_OUTPUT='unreferenced_functions.json'
+DEFAULT_MEMORY_LIMIT = 1024
+READ_SIZE = 1024 * 1024
+RUN_BLOCK_SIZE = 4096
+# Never merge more run files than this at once, to bound both the open files
+# and the blocks held in memory
+MAX_MERGE_FAN_IN = 16
+# Rough size in bytes of one sorted record (tuple, ints, list slot) besides
+# the characters of its symbol
+RECORD_OVERHEAD = 160
 
 
 DESCRIPTION = f"""
 Take the output from get_exports_imports.py (exports.json and imports.json) and
 save unreferenced exported functions as {DEFAULT_UNREF_OUTPUT}
+  With --external the JSON files are streamed, and the exports and imports
+    are sorted into run files on disk and merge-joined, using at most about
+    --memory_limit MB
 """
 USAGE_EXAMPLE = f"""
 Example:
@@ -29,6 +46,8 @@ For just ASpecificDLL.dll
 or for them all
 > pe_get_exports_imports.py -t ..\\..\\refdefs\\apps
 > {MY_NAME} -t .
+or when they do not fit in memory
+> {MY_NAME} -t . --external --memory_limit 4096
 
 """
 
@@ -42,12 +61,19 @@ def parse_arguments():
     )
     add = parser.add_argument
     add('-d', '--debug_level', type=int, default=0, help='set debug level')
+    add('-e', '--external', action='store_true',
+        help='match on disk, for when the JSON files do not fit in memory')
+    add('-m', '--memory_limit', type=int, default=DEFAULT_MEMORY_LIMIT,
+        metavar='MB',
+        help='memory to use with --external (default: %(default)s)')
 
     add('-q', '--quiet', action='store_true',
         help='be more quiet')
     add('-t', '--target_dir', metavar='DIR',
         default=os.getcwd(),
         help='root path to exports.json and imports.json of interest')
+    add('--tmp_dir', metavar='DIR',
+        help='where --external puts its run files (default: system temp)')
     add('-v', '--verbose', action='store_true',
         help='be more verbose')
 
@@ -116,6 +142,260 @@ def store_json_data(file, data):
     with open(file, 'w') as fp:
         json.dump(data, fp, indent=2)
 
+#-------------------------------------------------------------------------------
+def iterate_json_object(file):
+    '''Yield the (key, value) pairs of the top level object in file,
+    without reading more than one value at a time into memory'''
+    decoder = json.JSONDecoder()
+    with open(file) as fp:
+        buffer = ''
+        pos = 0
+        eof = False
+        # Where the buffer starts in the file, for the error messages
+        consumed = 0
+        consumed_lines = 0
+        consumed_column = 0
+
+        def read_more():
+            nonlocal buffer, pos, eof, consumed, consumed_lines, \
+                consumed_column
+            dropped = buffer[:pos]
+            consumed += len(dropped)
+            newlines = dropped.count('\n')
+            if newlines:
+                consumed_lines += newlines
+                consumed_column = len(dropped) - dropped.rfind('\n') - 1
+            else:
+                consumed_column += len(dropped)
+
+            chunk = fp.read(READ_SIZE)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def decode_error(message, at):
+            error = json.decoder.JSONDecodeError(message, buffer, at)
+            newlines = buffer.count('\n', 0, at)
+            error.pos = consumed + at
+            error.lineno = consumed_lines + newlines + 1
+            if newlines:
+                error.colno = at - buffer.rfind('\n', 0, at)
+            else:
+                error.colno = consumed_column + at + 1
+            error.args = (f'{message}: line {error.lineno} column ' +
+                f'{error.colno} (char {error.pos})',)
+            return error
+
+        def next_char():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise decode_error('Unexpected end of data', pos)
+                read_more()
+
+        def next_value():
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A value at the very end may still go on in the file
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.decoder.JSONDecodeError as e:
+                    if eof:
+                        raise decode_error(e.msg, e.pos) from None
+                read_more()
+
+        if next_char() != '{':
+            raise decode_error('Expected an object', pos)
+        pos += 1
+        if next_char() == '}':
+            return
+        while True:
+            key = next_value()
+            if next_char() != ':':
+                raise decode_error('Expected a colon', pos)
+            pos += 1
+            yield key, next_value()
+            separator = next_char()
+            pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise decode_error('Expected a comma', pos - 1)
+
+#-------------------------------------------------------------------------------
+def store_json_stream(file, items):
+    '''Like store_json_data() but for (key, value) pairs from an iterator.
+    The file is only replaced once all the items are written.'''
+    fd, temp_file = tempfile.mkstemp(suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(file)))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            separator = '{'
+            for key, value in items:
+                value_as_string = json.dumps(value, indent=2).replace('\n',
+                    '\n  ')
+                fp.write(f'{separator}\n  {json.dumps(key)}: ' +
+                    value_as_string)
+                separator = ','
+            fp.write('{}' if separator == '{' else '\n}')
+        os.replace(temp_file, file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+#-------------------------------------------------------------------------------
+def read_run(file):
+    with open(file, 'rb') as fp:
+        while True:
+            try:
+                block = pickle.load(fp)
+            except EOFError:
+                return
+            yield from block
+
+#-------------------------------------------------------------------------------
+class ExternalSorter:
+    '''Sort records that may not fit in memory by spilling sorted runs to disk
+    and merging them, at most MAX_MERGE_FAN_IN runs at a time'''
+    def __init__(self, tmp_dir, memory_limit):
+        self.tmp_dir = tmp_dir
+        self.memory_limit = memory_limit
+        self.records = []
+        self.size = 0
+        self.total_records = 0
+        self.total_size = 0
+        self.runs = []
+
+    def extend(self, records, symbols):
+        self.records.extend(records)
+        size = RECORD_OVERHEAD * len(symbols) + sum(map(len, symbols))
+        self.size += size
+        self.total_records += len(records)
+        self.total_size += size
+        if self.size >= self.memory_limit:
+            self.spill()
+
+    def block_size(self):
+        # A merge holds one block per run being read plus one being written
+        record_size = max(1, self.total_size // max(1, self.total_records))
+        block_bytes = self.memory_limit // (MAX_MERGE_FAN_IN + 1)
+        return min(RUN_BLOCK_SIZE, max(1, block_bytes // record_size))
+
+    def write_run(self, records):
+        block_size = self.block_size()
+        fd, file = tempfile.mkstemp(suffix='.run', dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as fp:
+            while True:
+                block = list(itertools.islice(records, block_size))
+                if not block:
+                    break
+                pickle.dump(block, fp, pickle.HIGHEST_PROTOCOL)
+        return file
+
+    def spill(self):
+        self.records.sort()
+        records = self.records
+        self.records = []
+        self.size = 0
+        self.runs.append(self.write_run(iter(records)))
+
+    def sorted(self):
+        if not self.runs:
+            self.records.sort()
+            return iter(self.records)
+        if self.records:
+            self.spill()
+        while len(self.runs) > MAX_MERGE_FAN_IN:
+            merging = self.runs[:MAX_MERGE_FAN_IN]
+            self.runs = self.runs[MAX_MERGE_FAN_IN:]
+            self.runs.append(self.write_run(
+                heapq.merge(*[read_run(file) for file in merging])))
+            for file in merging:
+                os.remove(file)
+        return heapq.merge(*[read_run(file) for file in self.runs])
+
+#-------------------------------------------------------------------------------
+def find_unreferenced_external(export_file, import_file, tmp_dir, options):
+    # The export, import and result sorters may all hold records at once
+    sorter_limit = options.memory_limit * 1024 * 1024 // 3
+    exporting_exes = []
+    exports = ExternalSorter(tmp_dir, sorter_limit)
+    for exporting_exe, defined_functions in iterate_json_object(export_file):
+        if not defined_functions:
+            if options.verbose:
+                print(f'{exporting_exe} had no exported functions')
+            continue
+        exe_index = len(exporting_exes)
+        exporting_exes.append(exporting_exe)
+        exporting_exe_key = ntpath.basename(exporting_exe)
+        exports.extend([(exporting_exe_key, function, exe_index, position)
+            for position, function in enumerate(defined_functions)],
+            defined_functions)
+
+    imports = ExternalSorter(tmp_dir, sorter_limit)
+    for importing_exe, imported_exes in iterate_json_object(import_file):
+        if not imported_exes:
+            continue
+        for defining_exe, referenced_functions in imported_exes.items():
+            imports.extend([(defining_exe, function)
+                for function in referenced_functions], referenced_functions)
+
+    print('Pruning out the used exported functions')
+    unreferenced = ExternalSorter(tmp_dir, sorter_limit)
+    records = []
+    functions = []
+    sorted_imports = imports.sorted()
+    imported = next(sorted_imports, None)
+    counted = None
+    for exporting_exe_key, function, exe_index, position in exports.sorted():
+        exported = (exporting_exe_key, function)
+        if exported != counted:
+            while imported is not None and imported < exported:
+                imported = next(sorted_imports, None)
+            no_of_references = 0
+            while imported == exported:
+                no_of_references += 1
+                imported = next(sorted_imports, None)
+            counted = exported
+            pruning_exe = None
+        # Like find_references_to(), every reference prunes only the first
+        # remaining occurrence of the function in each exporting exe
+        if exe_index != pruning_exe:
+            pruning_exe = exe_index
+            pruned = 0
+        if pruned < no_of_references:
+            pruned += 1
+            if options.verbose:
+                print(f'  - Pruning: {function} from ' +
+                    f'{exporting_exes[exe_index]}')
+            continue
+        records.append((exe_index, position, function))
+        functions.append(function)
+        if len(records) >= RUN_BLOCK_SIZE:
+            unreferenced.extend(records, functions)
+            records = []
+            functions = []
+    unreferenced.extend(records, functions)
+
+    # Put the remaining functions back in the order of exports.json
+    sorted_unreferenced = unreferenced.sorted()
+    left = next(sorted_unreferenced, None)
+    for exe_index, exporting_exe in enumerate(exporting_exes):
+        functions = []
+        while left is not None and left[0] == exe_index:
+            functions.append(left[2])
+            left = next(sorted_unreferenced, None)
+        yield exporting_exe, functions
+
 #-------------------------------------------------------------------------------
 def find_references_to(defining_exe, import_references,
     pruning_list_of_defines, options):
@@ -159,6 +439,19 @@ def main():
         print(f'No import file found as {import_file}')
         return 3
 
+    if options.external:
+        print('Collecting the exports and imports')
+        with tempfile.TemporaryDirectory(dir=options.tmp_dir) as tmp_dir:
+            try:
+                results = find_unreferenced_external(export_file, import_file,
+                    tmp_dir, options)
+                store_json_stream(DEFAULT_UNREF_OUTPUT, results)
+            except json.decoder.JSONDecodeError as e:
+                print(f'Could not read the exports or imports: {e}')
+                return 3
+        print(f'  Saved as {DEFAULT_UNREF_OUTPUT}')
+        return 0
+
     print('Collecting the exports')
     exports_defined = load_json_data(export_file)
     import_references = load_json_data(import_file)
@@ -176,7 +469,7 @@ def main():
 
         # Make a copy for pruning out all references
         pruning_list_of_defined_functions = defined_functions
-        exporting_exe_key = os.path.basename(exporting_exe)
+        exporting_exe_key = ntpath.basename(exporting_exe)
         pruning_list_of_defined_functions = find_references_to(
             exporting_exe_key, import_references,
             pruning_list_of_defined_functions, options)
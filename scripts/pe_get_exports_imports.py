@@ -7,23 +7,35 @@ import json
 import os
 # from   pathlib import Path
 import pefile
+import struct
 #import subprocess
 import sys
 import textwrap
+import worker_pool
 
 MY_NAME = os.path.basename(__file__)
 DEFAULT_EXP_OUTPUT='exports.json'
 DEFAULT_IMP_OUTPUT='imports.json'
+DEFAULT_UNREF_OUTPUT='unreferenced_functions.json'
+IMPORT_DESCRIPTOR_SIZE = 20
+MAX_IMPORT_DESCRIPTORS = 4096
 
 DESCRIPTION = f"""
 Index the executable files in the --target_dir, taking the information from
     the pefile and gather the data into
     {DEFAULT_EXP_OUTPUT} and {DEFAULT_IMP_OUTPUT}
+  Files that hit --timeout or --memory_limit (or make pefile throw) are
+    skipped and listed in {worker_pool.DEFAULT_QUARANTINE_OUTPUT}
+  With --targeted (and -u) only the binaries that import the -u dll get their
+    imports decoded, and its unused exports go straight into
+    {DEFAULT_UNREF_OUTPUT}
 """
 USAGE_EXAMPLE = f"""
 Example:
 > {MY_NAME} -t ../data
 > {MY_NAME} -t ../data -u just_this.dll
+> {MY_NAME} -t ../data --timeout 30 --memory_limit 2048
+> {MY_NAME} -t ../data -u just_this.dll --targeted
 """
 
 #-------------------------------------------------------------------------------
@@ -42,13 +54,20 @@ def parse_arguments():
         help='root path to check (recursively)')
     add('-u', '--unly_one', metavar='dll_under_test.dll',
         help='exports from this exe only')
+    add('--targeted', action='store_true',
+        help='only find the unused exports of the -u dll')
 
     add('-q', '--quiet', action='store_true',
         help='be more quiet')
     add('-v', '--verbose', action='store_true',
         help='be more verbose')
+    worker_pool.add_pool_arguments(add)
 
-    return parser.parse_args()
+    options = parser.parse_args()
+    worker_pool.check_pool_arguments(parser, options)
+    if options.targeted and not options.unly_one:
+        parser.error('--targeted needs -u/--unly_one')
+    return options
 
 #-------------------------------------------------------------------------------
 def list_all_files(directory, the_chosen_files, ext):
@@ -70,6 +89,8 @@ def list_all_executables(directory):
 
 #-------------------------------------------------------------------------------
 def get_import(file, interesting_dlls, options):
+    if options.verbose:
+        print(file)
     imports = {}
 
     try:
@@ -111,6 +132,75 @@ def get_import(file, interesting_dlls, options):
 
     return imports
 
+#-------------------------------------------------------------------------------
+def get_imported_dll_names(file):
+    '''Read just the DLL names of the import descriptors, no thunks'''
+    pe = pefile.PE(file, fast_load=True)
+    dll_names = []
+    try:
+        import_index = pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_IMPORT"]
+        rva = pe.OPTIONAL_HEADER.DATA_DIRECTORY[import_index].VirtualAddress
+        if not rva:
+            return dll_names
+
+        for _ in range(MAX_IMPORT_DESCRIPTORS):
+            descriptor = pe.get_data(rva, IMPORT_DESCRIPTOR_SIZE)
+            if len(descriptor) < IMPORT_DESCRIPTOR_SIZE:
+                break
+            # OriginalFirstThunk, TimeDateStamp, ForwarderChain, Name,
+            # FirstThunk
+            fields = struct.unpack('<5I', descriptor)
+            if not any(fields):
+                break
+            name_rva = fields[3]
+            if name_rva:
+                dll_names.append(
+                    pe.get_string_at_rva(name_rva).decode('utf8'))
+            rva += IMPORT_DESCRIPTOR_SIZE
+    finally:
+        pe.close()
+
+    return dll_names
+
+#-------------------------------------------------------------------------------
+def get_targeted_import(file, target_dll, options):
+    target_key = target_dll.lower()
+    dll_names = get_imported_dll_names(file)
+    matching_dlls = [dll for dll in dll_names if dll.lower() == target_key]
+    if not matching_dlls:
+        return []
+
+    # This one does import the target, so decode it all
+    imports = get_import(file, matching_dlls, options)
+    signatures = []
+    for imported_dll, functions in imports.items():
+        if imported_dll.lower() == target_key:
+            signatures.extend(functions)
+    return signatures
+
+#-------------------------------------------------------------------------------
+def get_targeted_unreferenced(executables, exports, options, quarantine):
+    imports_from_exes = worker_pool.run_guarded(get_targeted_import,
+        executables, (options.unly_one, options), options, quarantine,
+        'imports')
+
+    referenced_functions = set()
+    for exe, signatures in imports_from_exes.items():
+        if signatures and options.verbose:
+            print(f'  {options.unly_one} imported by {exe}')
+        referenced_functions.update(signatures)
+
+    results = {}
+    for exporting_exe, defined_functions in exports.items():
+        if not defined_functions:
+            if options.verbose:
+                print(f'{exporting_exe} had no exported functions')
+            continue
+        results[exporting_exe] = [function for function in defined_functions
+            if function not in referenced_functions]
+
+    return results
+
 #-------------------------------------------------------------------------------
 def get_basenames(inputs):
     outputs = []
@@ -120,19 +210,20 @@ def get_basenames(inputs):
     return outputs
 
 #-------------------------------------------------------------------------------
-def get_imports(executables, options):
+def get_imports(executables, options, quarantine):
     imports = {}
     interesting_dlls = get_basenames(executables)
-    for exe in executables:
-        if options.verbose:
-            print(exe)
-        imports[os.path.basename(exe)] = get_import(exe, interesting_dlls,
-            options)
+    imports_from_exes = worker_pool.run_guarded(get_import, executables,
+        (interesting_dlls, options), options, quarantine, 'imports')
+    for exe, imports_from_dlls in imports_from_exes.items():
+        imports[os.path.basename(exe)] = imports_from_dlls
 
     return imports
 
 #-------------------------------------------------------------------------------
 def get_signatures(file, options):
+    if options.verbose:
+        print(file)
     signatures = []
     try:
         export_dir = [pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_EXPORT"]]
@@ -162,8 +253,8 @@ def get_signatures(file, options):
     return signatures
 
 #-------------------------------------------------------------------------------
-def get_exports(executables, options):
-    exports = {}
+def get_exports(executables, options, quarantine):
+    files = []
     for file in executables:
 #        file = str(file)
         if options.unly_one and os.path.basename(file) != options.unly_one:
@@ -175,11 +266,10 @@ def get_exports(executables, options):
             print(f'Test file {file} does not exist')
             return
 
-        if options.verbose:
-            print(file)
-        signatures = get_signatures(file, options)
-        exports[file] = signatures
+        files.append(file)
 
+    exports = worker_pool.run_guarded(get_signatures, files, (options,),
+        options, quarantine, 'exports')
     return exports
 
 #-------------------------------------------------------------------------------
@@ -199,17 +289,30 @@ def main(options):
         return 3
 
     print('Collecting the exports')
-    exports = get_exports(exes, options)
-    if not len(exports):
+    quarantine = []
+    exports = get_exports(exes, options, quarantine)
+    if not exports:
         print(f'Got no exports - giving up')
         return 3
     store_json_data(DEFAULT_EXP_OUTPUT, exports)
     print(f'  Saved as {DEFAULT_EXP_OUTPUT}')
 
-    print('Collecting the imports')
-    imports = get_imports(exes, options)
-    store_json_data(DEFAULT_IMP_OUTPUT, imports)
-    print(f'  Saved as {DEFAULT_IMP_OUTPUT}')
+    if options.targeted:
+        print(f'Collecting the imports from {options.unly_one}')
+        results = get_targeted_unreferenced(exes, exports, options,
+            quarantine)
+        store_json_data(DEFAULT_UNREF_OUTPUT, results)
+        print(f'  Saved as {DEFAULT_UNREF_OUTPUT}')
+    else:
+        print('Collecting the imports')
+        imports = get_imports(exes, options, quarantine)
+        store_json_data(DEFAULT_IMP_OUTPUT, imports)
+        print(f'  Saved as {DEFAULT_IMP_OUTPUT}')
+
+    if quarantine:
+        store_json_data(worker_pool.DEFAULT_QUARANTINE_OUTPUT, quarantine)
+        print(f'  {len(quarantine)} files quarantined, see ' +
+            f'{worker_pool.DEFAULT_QUARANTINE_OUTPUT}')
 
     return ret_val
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# Run a per-file function in a pool of recyclable worker processes.
+# A file that makes its worker hang, run out of memory or die is killed
+# off, quarantined and the worker replaced, so the rest of the run goes on.
+#-------------------------------------------------------------------------------
+
+import collections
+import multiprocessing
+import multiprocessing.connection
+import os
+import subprocess
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_TASKS = 200
+DEFAULT_QUARANTINE_OUTPUT = 'quarantine.json'
+
+# Extra time for the worker itself, on top of the per-file timeout, so that a
+# subprocess run with the same timeout inside the worker gets to time out first.
+# Also how long a worker gets to shut down nicely.
+GRACE_TIME = 5
+
+#-------------------------------------------------------------------------------
+def add_pool_arguments(add):
+    add('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='number of worker processes (default: %(default)s)')
+    add('--timeout', type=int, default=DEFAULT_TIMEOUT, metavar='SECONDS',
+        help='max time spent on one file (default: %(default)s)')
+    add('--memory_limit', type=int, default=0, metavar='MB',
+        help='max memory for a worker process, 0 means no limit ' +
+            '(not supported on Windows)')
+    add('--max_tasks', type=int, default=DEFAULT_MAX_TASKS,
+        help='recycle a worker after this many files (default: %(default)s)')
+
+#-------------------------------------------------------------------------------
+def check_pool_arguments(parser, options):
+    if options.memory_limit and resource is None:
+        parser.error('--memory_limit is not supported on this platform')
+
+#-------------------------------------------------------------------------------
+def limit_memory(memory_limit):
+    if not memory_limit or resource is None:
+        return
+    limit = memory_limit * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+#-------------------------------------------------------------------------------
+def worker_main(conn, func, args, memory_limit):
+    limit_memory(memory_limit)
+    while True:
+        try:
+            file = conn.recv()
+        except EOFError:
+            break
+        if file is None:
+            break
+        try:
+            reply = ('ok', func(file, *args))
+        except MemoryError:
+            reply = ('memory', 'exceeded the memory limit')
+        except subprocess.TimeoutExpired as e:
+            reply = ('timeout', f'{e}')
+        except Exception as e:
+            reply = ('error', f'{type(e).__name__}: {e}')
+        conn.send(reply)
+    conn.close()
+
+#-------------------------------------------------------------------------------
+class Worker:
+    def __init__(self, func, args, options):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main,
+            args=(child_conn, func, args, options.memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.deadline = None
+        self.done = 0
+
+    def start(self, index, file, time_limit):
+        self.task = (index, file)
+        self.deadline = time.monotonic() + time_limit
+        self.conn.send(file)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(GRACE_TIME)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+#-------------------------------------------------------------------------------
+def run_guarded(func, files, args, options, quarantine, phase,
+    grace_time=0):
+    '''Call func(file, *args) for every file, returning {file: result}.
+
+    Files that time out, exceed the memory limit, crash or throw are left
+    out of the result and get an entry in quarantine instead. A worker gets
+    grace_time seconds on top of --timeout before it is killed.
+    '''
+    time_limit = options.timeout + grace_time
+    results = [None] * len(files)
+    succeeded = [False] * len(files)
+    pending = collections.deque(enumerate(files))
+    no_of_workers = max(1, min(options.jobs, len(files)))
+    idle = [Worker(func, args, options) for _ in range(no_of_workers)]
+    busy = []
+
+    def quarantine_task(worker, reason, message):
+        _index, file = worker.task
+        if not options.quiet:
+            print(f'  Quarantined {file} ({reason})')
+        quarantine.append({'file': file, 'phase': phase,
+            'reason': reason, 'message': message})
+
+    while pending or busy:
+        while idle and pending:
+            worker = idle.pop()
+            index, file = pending.popleft()
+            worker.start(index, file, time_limit)
+            busy.append(worker)
+
+        first_deadline = min(worker.deadline for worker in busy)
+        wait_time = max(0, first_deadline - time.monotonic())
+        ready = multiprocessing.connection.wait(
+            [worker.conn for worker in busy], wait_time)
+
+        still_busy = []
+        for worker in busy:
+            if worker.conn in ready:
+                try:
+                    status, value = worker.conn.recv()
+                except EOFError:
+                    status, value = 'crashed', 'worker process died'
+            elif time.monotonic() >= worker.deadline:
+                status, value = 'timeout', \
+                    f'no reply within {time_limit} seconds'
+            else:
+                still_busy.append(worker)
+                continue
+
+            worker.done += 1
+            if status == 'ok':
+                results[worker.task[0]] = value
+                succeeded[worker.task[0]] = True
+            else:
+                quarantine_task(worker, status, value)
+
+            # A failing worker may be in any state, so never reuse it
+            if status != 'ok' or worker.done >= options.max_tasks:
+                if status == 'ok':
+                    worker.stop()
+                else:
+                    worker.kill()
+                if pending:
+                    idle.append(Worker(func, args, options))
+            else:
+                idle.append(worker)
+            worker.task = None
+        busy = still_busy
+
+    for worker in idle:
+        worker.stop()
+
+    return {file: result
+        for file, result, ok in zip(files, results, succeeded) if ok}